@@ -1,29 +1,206 @@
 import os
-import sys
 import threading
 import tkinter as tk
-from tkinter import filedialog, scrolledtext, ttk
 import queue
-import json
-import time
+import math
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # 导入自定义模块
 from ollama_client import OllamaClient
 from project_manager import ProjectManager
 from ui_manager import UIManager
 
+# AI响应中计划信息的匹配模式：先定位关键词，再从关键词之后匹配计划内容
+_PLAN_KEYWORD_RE = re.compile(r"下一步计划|接下来我将|计划如下|我的计划是")
+_PLAN_TEXT_RE = re.compile(r"[:：]?\s*(.+?)(?=\n\n|$)")
+
+# 文件块的起始标记和结束标记
+_FILE_MARKER = "```file:"
+_FENCE = "```"
+
+# 绝对路径的起始字符（Windows下还需检查盘符）
+_ABS_PREFIXES = ("/", "\\") if os.name == "nt" else ("/",)
+
+def _is_abs_path(file_path):
+    """快速判断路径是否为绝对路径"""
+    if file_path.startswith(_ABS_PREFIXES):
+        return True
+    return os.name == "nt" and len(file_path) > 1 and file_path[1] == ":"
+
+class _StreamFileExtractor:
+    """增量解析AI响应中的文件块
+    
+    以小型状态机逐段处理文本，可以直接接收流式响应的数据块，
+    每当一个文件块完整时立即返回，无需等待整个响应结束。
+    结果与 ```file:<路径>\n<内容>``` 格式的正则匹配一致。
+    """
+    _TEXT, _IN_PATH, _IN_BODY = range(3)
+    
+    def __init__(self):
+        self._state = self._TEXT
+        self._buffer = ""  # 可能跨数据块的未处理文本（标记前缀、路径或内容末尾）
+        self._path = ""
+        self._body_parts = []
+        self._body_len = 0
+    
+    def feed(self, text):
+        """处理新收到的文本
+        
+        Args:
+            text: 新收到的文本
+            
+        Returns:
+            本次完成的 (文件路径, 文件内容) 元组列表
+        """
+        blocks = []
+        while text:
+            if self._state == self._TEXT:
+                text = self._buffer + text
+                self._buffer = ""
+                index = text.find(_FILE_MARKER)
+                if index == -1:
+                    # 保留可能是起始标记前缀的末尾部分
+                    self._buffer = text[-(len(_FILE_MARKER) - 1):]
+                    break
+                text = text[index + len(_FILE_MARKER):]
+                self._state = self._IN_PATH
+            
+            elif self._state == self._IN_PATH:
+                index = text.find("\n")
+                if index == -1:
+                    self._buffer += text
+                    break
+                path = self._buffer + text[:index]
+                self._buffer = ""
+                if path:
+                    self._path = path
+                    self._state = self._IN_BODY
+                    text = text[index + 1:]
+                else:
+                    # 路径为空，不是有效的文件块
+                    self._state = self._TEXT
+                    text = text[index:]
+            
+            else:
+                # 在上一段内容的末尾和新文本中查找结束标记，文件内容至少包含一个字符
+                window = self._buffer + text
+                offset = self._body_len - len(self._buffer)
+                index = window.find(_FENCE, max(0, 1 - offset))
+                if index == -1:
+                    self._body_parts.append(text)
+                    self._body_len += len(text)
+                    self._buffer = window[-(len(_FENCE) - 1):]
+                    break
+                
+                body = "".join(self._body_parts) + text
+                end = offset + index
+                blocks.append((self._path, body[:end]))
+                text = body[end + len(_FENCE):]
+                self._state = self._TEXT
+                self._buffer = ""
+                self._path = ""
+                self._body_parts = []
+                self._body_len = 0
+        
+        return blocks
+
+def _extract_plans(response):
+    """提取响应中的计划信息
+    
+    先用关键词定位可能的位置，只在关键词之后匹配计划内容，
+    响应中没有关键词时只需一次线性扫描。
+    
+    Args:
+        response: AI的响应文本
+        
+    Returns:
+        计划文本列表
+    """
+    plans = []
+    pos = 0
+    while True:
+        keyword = _PLAN_KEYWORD_RE.search(response, pos)
+        if not keyword:
+            return plans
+        plan = _PLAN_TEXT_RE.match(response, keyword.end())
+        if not plan:
+            pos = keyword.start() + 1
+            continue
+        plan_text = plan.group(1).strip()
+        if plan_text:
+            plans.append(plan_text)
+        pos = plan.end()
+
+class _OrderedFileWriter:
+    """在线程池中并行保存文件，同一路径最终保留版本号最大的内容
+    
+    同一路径的写入持有该路径的锁串行执行；在执行前已被更高版本取代的写入会被跳过。
+    """
+    
+    def __init__(self, save, max_workers=8):
+        """初始化写入器
+        
+        Args:
+            save: 以 (文件路径, 文件内容) 调用的保存函数
+            max_workers: 写入线程数
+        """
+        self._save = save
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._latest = {}  # 规范化路径 -> 最新版本号
+        self._path_locks = {}  # 规范化路径 -> 该路径的写入锁
+        self._futures = []
+    
+    def submit(self, version, file_path, file_content):
+        """提交一次写入
+        
+        Args:
+            version: 版本号，可比较大小，越大越新
+            file_path: 文件的绝对路径
+            file_content: 文件内容
+            
+        Returns:
+            是否提交成功，版本低于已提交的版本时返回False
+        """
+        key = os.path.normcase(os.path.normpath(file_path))
+        with self._lock:
+            latest = self._latest.get(key)
+            if latest is not None and version < latest:
+                return False
+            self._latest[key] = version
+            path_lock = self._path_locks.setdefault(key, threading.Lock())
+        self._futures.append(self._pool.submit(self._write, key, version, path_lock, file_path, file_content))
+        return True
+    
+    def _write(self, key, version, path_lock, file_path, file_content):
+        """执行写入，版本已被取代时跳过"""
+        with path_lock:
+            with self._lock:
+                if self._latest[key] != version:
+                    return
+            self._save(file_path, file_content)
+    
+    def close(self):
+        """等待所有写入完成，写入出错时抛出第一个异常"""
+        self._pool.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+
 class AIProjectBuilder:
     def __init__(self, root):
         self.root = root
         self.root.title("AI项目构建器")
         self.root.geometry("1000x700")
         
-        # 创建队列用于线程间通信
-        self.message_queue = queue.Queue()
+        # 创建队列用于线程间通信，限制大小避免流式进度消息占用过多内存
+        # 队列只由后台线程写入；主线程中的回调直接更新界面，避免队列已满时阻塞主线程
+        self.message_queue = queue.Queue(maxsize=256)
         
         # 初始化组件
-        self.ollama_client = OllamaClient()
         self.project_manager = ProjectManager()
+        self.ollama_client = OllamaClient(project_manager=self.project_manager)
         self.ui_manager = UIManager(self.root, self.message_queue, self.start_project_generation, 
                                    self.select_project_folder, self.update_ollama_settings)
         
@@ -32,27 +209,33 @@ class AIProjectBuilder:
         self.requirement = ""
         self.model_name = "deepseek-coder-v2:latest"
         self.ollama_api_url = "http://localhost:11434/api"
+        self.max_embed_files = 200  # 参与相关度排序的最大文件数，避免向量计算拖慢生成
         
-        # 启动UI更新线程
-        self.running = True
-        self.update_thread = threading.Thread(target=self.update_ui_from_queue)
-        self.update_thread.daemon = True
-        self.update_thread.start()
+        # 窗口关闭后后台线程不再等待写入消息队列
+        self._closing = threading.Event()
+        
+        # 保护多个写入线程共用的已创建目录集合
+        self._dirs_lock = threading.Lock()
+        
+        # 在Tk主循环中定时处理消息队列
+        self.root.after(50, self._drain_queue)
     
     def select_project_folder(self):
         """选择项目文件夹"""
+        from tkinter import filedialog  # 首次使用时再导入，缩短启动时间
+        
         folder = filedialog.askdirectory()
         if folder:
             self.project_path = folder
             self.ui_manager.update_project_path(folder)
-            self.message_queue.put({"type": "status", "message": f"已选择项目路径: {folder}"})
+            self.ui_manager.update_status(f"已选择项目路径: {folder}")
     
     def update_ollama_settings(self, api_url, model_name):
         """更新Ollama设置"""
         self.ollama_api_url = api_url
         self.model_name = model_name
         self.ollama_client.update_settings(api_url, model_name)
-        self.message_queue.put({"type": "status", "message": f"已更新Ollama设置 - API: {api_url}, 模型: {model_name}"})
+        self.ui_manager.update_status(f"已更新Ollama设置 - API: {api_url}, 模型: {model_name}")
     
     def start_project_generation(self, requirement, is_new_project):
         """启动项目生成过程"""
@@ -60,17 +243,17 @@ class AIProjectBuilder:
         
         # 检查项目路径
         if not self.project_path:
-            self.message_queue.put({"type": "error", "message": "请先选择项目文件夹"})
+            self.ui_manager.update_error("请先选择项目文件夹")
             return
         
         # 检查需求
         if not requirement.strip():
-            self.message_queue.put({"type": "error", "message": "请输入项目需求"})
+            self.ui_manager.update_error("请输入项目需求")
             return
         
         # 清空日志并显示开始信息
         self.ui_manager.clear_logs()
-        self.message_queue.put({"type": "status", "message": "开始处理项目需求..."})
+        self.ui_manager.update_status("开始处理项目需求...")
         
         # 在新线程中运行项目生成
         generation_thread = threading.Thread(
@@ -84,36 +267,76 @@ class AIProjectBuilder:
         """在单独的线程中运行项目生成"""
         try:
             # 准备项目上下文
+            project_files = None
             if is_new_project:
-                self.message_queue.put({"type": "status", "message": "创建新项目..."})
+                self._post({"type": "status", "message": "创建新项目..."})
                 os.makedirs(self.project_path, exist_ok=True)
             else:
-                self.message_queue.put({"type": "status", "message": "分析现有项目..."})
+                self._post({"type": "status", "message": "分析现有项目..."})
                 project_files = self.project_manager.scan_project(self.project_path)
-                self.message_queue.put({"type": "status", "message": f"找到 {len(project_files)} 个文件"})
+                self._post({"type": "status", "message": f"找到 {len(project_files)} 个文件"})
             
             # 构建提示词
-            prompt = self.build_prompt(requirement, is_new_project)
+            prompt = self.build_prompt(requirement, is_new_project, project_files)
             
             # 调用AI生成代码
-            self.message_queue.put({"type": "status", "message": "正在使用AI生成代码..."})
-            self.message_queue.put({"type": "plan", "message": "分析需求并规划项目结构"})
+            self._post({"type": "status", "message": "正在使用AI生成代码..."})
+            self._post({"type": "plan", "message": "分析需求并规划项目结构"})
+            
+            # 实时显示已接收的内容长度，并在文件块完整时立即保存
+            received = [0]
+            extractors = {}  # 响应序号 -> _StreamFileExtractor
+            files_saved = {}  # 响应序号 -> 已保存的文件数
+            made_dirs = set()
+            project_prefix = self._project_prefix()
+            writer = _OrderedFileWriter(
+                lambda file_path, file_content: self._save_ai_file(file_path, file_content, made_dirs, project_prefix)
+            )
+            block_count = [0]
+            def on_chunk(index, text):
+                received[0] += len(text)
+                try:
+                    # 进度消息可以丢弃，队列已满时不阻塞生成过程
+                    self.message_queue.put_nowait({"type": "progress", "message": f"正在接收AI响应... 已接收 {received[0]} 个字符"})
+                except queue.Full:
+                    pass
+                
+                extractor = extractors.get(index)
+                if extractor is None:
+                    extractor = extractors[index] = _StreamFileExtractor()
+                    files_saved[index] = 0
+                for file_path, file_content in extractor.feed(text):
+                    # 在线程池中写入，不阻塞响应的接收
+                    # 同一路径出现多次时，保留序号最大的响应中最后的内容，
+                    # 与按响应顺序依次写入的结果一致（例如完善阶段的响应覆盖实现阶段的响应）
+                    block_count[0] += 1
+                    writer.submit((index, block_count[0]), self._resolve_ai_path(file_path, project_prefix), file_content)
+                    files_saved[index] += 1
             
             # 分段处理大型上下文
-            responses = self.ollama_client.generate_with_context(prompt, self.project_path)
+            try:
+                responses = self.ollama_client.generate_with_context(prompt, self.project_path, on_chunk)
+            finally:
+                writer.close()
             
-            # 处理AI响应
+            # 处理AI响应，流式接收时已保存的文件不再重复写入
             for i, response in enumerate(responses):
-                self.process_ai_response(response, i+1, len(responses))
+                self.process_ai_response(response, i+1, len(responses), files_saved.get(i))
             
-            self.message_queue.put({"type": "status", "message": "项目生成完成!"})
-            self.message_queue.put({"type": "plan", "message": "所有任务已完成"})
+            self._post({"type": "status", "message": "项目生成完成!"})
+            self._post({"type": "plan", "message": "所有任务已完成"})
             
         except Exception as e:
-            self.message_queue.put({"type": "error", "message": f"错误: {str(e)}"})
+            self._post({"type": "error", "message": f"错误: {str(e)}"})
     
-    def build_prompt(self, requirement, is_new_project):
-        """构建提示词"""
+    def build_prompt(self, requirement, is_new_project, project_files=None):
+        """构建提示词
+        
+        Args:
+            requirement: 用户需求
+            is_new_project: 是否为新项目
+            project_files: 已扫描的项目文件列表，为None时重新扫描
+        """
         if is_new_project:
             prompt = (
                 "你是一个专业的软件开发助手，精通各种编程语言和框架。\n\n"
@@ -156,92 +379,212 @@ class AIProjectBuilder:
                 "# 现有项目文件\n"
             )
             # 添加项目文件列表和内容摘要
-            project_files = self.project_manager.scan_project(self.project_path)
-            for file_path in project_files[:10]:  # 限制文件数量，避免超出上下文限制
-                relative_path = os.path.relpath(file_path, self.project_path)
-                prompt += f"- {relative_path}\n"
-            
-            prompt += "\n如果需要查看更多文件内容，请在回复中说明。\n"
+            if project_files is None:
+                project_files = self.project_manager.scan_project(self.project_path)
+            # 限制文件数量，避免超出上下文限制
+            parts = [prompt]
+            parts.extend(
+                f"- {os.path.relpath(file_path, self.project_path)}\n"
+                for file_path in self._select_relevant_files(requirement, project_files, 10)
+            )
+            parts.append("\n如果需要查看更多文件内容，请在回复中说明。\n")
+            prompt = "".join(parts)
         
         return prompt
     
-    def process_ai_response(self, response, current_part, total_parts):
-        """处理AI的响应，提取文件并保存"""
-        self.message_queue.put({"type": "status", "message": f"处理AI响应 ({current_part}/{total_parts})..."})
+    def _select_relevant_files(self, requirement, project_files, top_k):
+        """按与需求的相关度选择项目文件
         
-        # 解析响应中的文件
-        file_pattern = r"```file:(.+?)\n([\s\S]+?)```"
-        import re
-        matches = re.finditer(file_pattern, response)
+        将需求和前 max_embed_files 个文件的摘要（路径和开头内容）一次性批量计算向量，
+        按余弦相似度选出最相关的文件。向量计算失败时退回到前top_k个文件。
         
-        files_processed = 0
-        for match in matches:
-            file_path = match.group(1).strip()
-            file_content = match.group(2)
+        Args:
+            requirement: 用户需求
+            project_files: 项目文件路径列表
+            top_k: 最多选择的文件数量
             
-            # 确保文件路径是绝对路径
-            if not os.path.isabs(file_path):
-                file_path = os.path.join(self.project_path, file_path)
+        Returns:
+            选中的文件路径列表
+        """
+        if len(project_files) <= top_k:
+            return project_files
+        
+        candidates = project_files[:self.max_embed_files]
+        summaries = []
+        for file_path in candidates:
+            relative_path = os.path.relpath(file_path, self.project_path)
+            summaries.append(f"{relative_path}\n{self.project_manager.read_file_head(file_path)}")
+        
+        embeddings = self.ollama_client.embed_batch([requirement] + summaries)
+        if not embeddings:
+            return project_files[:top_k]
+        
+        query = embeddings[0]
+        query_norm = math.sqrt(sum(x * x for x in query))
+        scores = []
+        for index, vector in enumerate(embeddings[1:]):
+            norm = math.sqrt(sum(x * x for x in vector))
+            dot = sum(a * b for a, b in zip(query, vector))
+            scores.append((dot / (query_norm * norm) if query_norm and norm else 0.0, index))
+        
+        scores.sort(key=lambda item: item[0], reverse=True)
+        return [candidates[index] for _, index in scores[:top_k]]
+    
+    def process_ai_response(self, response, current_part, total_parts, files_saved=None):
+        """处理AI的响应，提取文件并保存
+        
+        Args:
+            response: AI的响应文本
+            current_part: 当前响应的序号
+            total_parts: 响应总数
+            files_saved: 流式接收时已保存的文件数，为None时从响应中提取并保存文件
+        """
+        self._post({"type": "status", "message": f"处理AI响应 ({current_part}/{total_parts})..."})
+        
+        # 保存响应中的文件，写入操作会释放GIL，在线程池中并行执行
+        files_processed = files_saved
+        if files_processed is None:
+            blocks = _StreamFileExtractor().feed(response)
+            files_processed = len(blocks)
+            made_dirs = set()  # 本次已确保存在的目录
+            project_prefix = self._project_prefix()
             
-            # 创建目录（如果不存在）
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            # 同一路径出现多次时只保留最后一个文件块，与按顺序写入的结果一致
+            latest_blocks = {}
+            for file_path, file_content in blocks:
+                file_path = self._resolve_ai_path(file_path, project_prefix)
+                key = os.path.normcase(os.path.normpath(file_path))
+                latest_blocks.pop(key, None)
+                latest_blocks[key] = (file_path, file_content)
             
-            # 保存文件
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(file_content)
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = [executor.submit(self._save_ai_file, file_path, file_content, made_dirs, project_prefix)
+                           for file_path, file_content in latest_blocks.values()]
+            for future in futures:
+                future.result()
+        
+        # 显示计划信息
+        for plan_text in _extract_plans(response):
+            self._post({"type": "plan", "message": plan_text})
+        
+        if files_processed == 0:
+            self._post({"type": "status", "message": "此部分响应中没有找到文件"})
+    
+    def _project_prefix(self):
+        """返回项目路径前缀（以路径分隔符结尾），每次运行或每个响应计算一次"""
+        return self.project_path.rstrip(os.sep + (os.altsep or "")) + os.sep
+    
+    def _resolve_ai_path(self, file_path, project_prefix):
+        """将响应中的文件路径转换为绝对路径
+        
+        Args:
+            file_path: 响应中的文件路径，相对路径基于项目路径
+            project_prefix: _project_prefix() 的返回值
             
-            files_processed += 1
+        Returns:
+            绝对路径
+        """
+        file_path = file_path.strip()
+        if not _is_abs_path(file_path):
+            file_path = project_prefix + file_path
+        return file_path
+    
+    def _save_ai_file(self, file_path, file_content, made_dirs, project_prefix):
+        """保存AI生成的单个文件
+        
+        Args:
+            file_path: 文件的绝对路径
+            file_content: 文件内容
+            made_dirs: 已确保存在的目录集合，会被更新；可以在多个线程中共用
+            project_prefix: _project_prefix() 的返回值
+        """
+        # 创建目录（如果不存在）
+        dir_path = os.path.dirname(file_path)
+        with self._dirs_lock:
+            need_dir = dir_path not in made_dirs
+        if need_dir:
+            os.makedirs(dir_path, exist_ok=True)
+            with self._dirs_lock:
+                made_dirs.add(dir_path)
+        
+        # 先写入临时文件再替换，避免中断时留下不完整的文件
+        tmp_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # 使用文本模式写入，保留平台的换行符转换（Windows下为CRLF）
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(file_content)
+            # 保留被覆盖文件的权限
+            if os.path.exists(file_path):
+                shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        if file_path.startswith(project_prefix):
+            relative_path = file_path[len(project_prefix):]
+        else:
             relative_path = os.path.relpath(file_path, self.project_path)
-            self.message_queue.put({"type": "file", "message": f"已保存文件: {relative_path}"})
+        self._post({"type": "file", "message": f"已保存文件: {relative_path}"})
+    
+    def _post(self, message):
+        """从后台线程发送消息
         
-        # 提取计划信息
-        plans = re.finditer(r"(?:下一步计划|接下来我将|计划如下|我的计划是)[:：]?\s*(.+?)(?=\n\n|$)", response)
-        for plan in plans:
-            plan_text = plan.group(1).strip()
-            if plan_text:
-                self.message_queue.put({"type": "plan", "message": plan_text})
+        队列已满时等待主线程处理，但窗口关闭后直接丢弃消息，
+        避免后台线程在没有消费者的队列上永远阻塞，导致进程无法退出。
         
-        if files_processed == 0:
-            self.message_queue.put({"type": "status", "message": "此部分响应中没有找到文件"})
+        Args:
+            message: 消息字典
+        """
+        while not self._closing.is_set():
+            try:
+                self.message_queue.put(message, timeout=0.1)
+                return
+            except queue.Full:
+                continue
     
-    def update_ui_from_queue(self):
-        """从队列更新UI"""
-        while self.running:
+    def _drain_queue(self):
+        """在Tk主线程中处理队列中的所有消息，然后重新调度自身
+        
+        同一批次中的进度消息只显示最后一条，其他消息按顺序全部处理。
+        """
+        last_progress = None
+        while True:
             try:
                 # 非阻塞方式获取消息
-                message = self.message_queue.get(block=False)
-                message_type = message.get("type", "")
-                message_text = message.get("message", "")
-                
-                if message_type == "status":
-                    self.ui_manager.update_status(message_text)
-                elif message_type == "error":
-                    self.ui_manager.update_error(message_text)
-                elif message_type == "file":
-                    self.ui_manager.update_file_log(message_text)
-                elif message_type == "plan":
-                    self.ui_manager.update_plan(message_text)
-                
-                self.message_queue.task_done()
+                message = self.message_queue.get_nowait()
             except queue.Empty:
-                pass
+                break
             
-            # 短暂休眠，避免CPU占用过高
-            time.sleep(0.1)
+            message_type = message.get("type", "")
+            message_text = message.get("message", "")
             
-            # 更新UI
-            try:
-                self.root.update()
-            except tk.TclError:
-                # 窗口已关闭
-                self.running = False
-                break
+            # 状态和错误消息会覆盖状态栏，之前的进度已经过时
+            if message_type == "status":
+                last_progress = None
+                self.ui_manager.update_status(message_text)
+            elif message_type == "error":
+                last_progress = None
+                self.ui_manager.update_error(message_text)
+            elif message_type == "file":
+                self.ui_manager.update_file_log(message_text)
+            elif message_type == "plan":
+                self.ui_manager.update_plan(message_text)
+            elif message_type == "progress":
+                last_progress = message_text
+            
+            self.message_queue.task_done()
+        
+        if last_progress is not None:
+            self.ui_manager.update_progress(last_progress)
+        
+        self.root.after(50, self._drain_queue)
     
     def on_closing(self):
         """窗口关闭时的处理"""
-        self.running = False
+        self._closing.set()
         self.root.destroy()
-        sys.exit(0)
 
 def main():
     root = tk.Tk()
@@ -1,19 +1,39 @@
-import requests
+import asyncio
 import json
 import time
 import os
+import re
+import hashlib
+import tempfile
+
+from project_manager import ProjectManager
+
+# 规划响应中文件路径的匹配模式
+_FILE_HDR_RE = re.compile(r"```file:([^\n]+)\n")
+_STRUCT_RE = re.compile(r"(?:项目结构|文件结构|目录结构)[:：]?\s*[\s\S]*?(?:```|\n\n)")
+_PATH_RE = re.compile(r"[\w\-\.]+\.[\w]+")  # 简单的文件名模式
 
 class OllamaClient:
-    def __init__(self, api_url="http://localhost:11434/api", model_name="deepseek-coder-v2:latest"):
+    def __init__(self, api_url="http://localhost:11434/api", model_name="deepseek-coder-v2:latest", project_manager=None):
         """初始化Ollama客户端
         
         Args:
             api_url: Ollama API的URL
             model_name: 使用的模型名称
+            project_manager: 用于读取项目文件的ProjectManager，为None时自动创建
         """
         self.api_url = api_url
         self.model_name = model_name
         self.timeout = 10000  # 设置超时为10000秒
+        self.num_predict = 4096  # 生成的最大token数量
+        self.embed_model = "nomic-embed-text"  # 用于计算文本向量的模型
+        
+        # 响应缓存设置
+        self.cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "codesovereign", "ollama")
+        self.cache_ttl = 24 * 60 * 60  # 缓存有效期（秒）
+        self.cache_max_entries = 2000  # 缓存的最大条目数
+        self._cache_entries = None  # 缓存条目数，首次写入时统计一次，之后随写入递增
+        self.project_manager = project_manager or ProjectManager()
     
     def update_settings(self, api_url, model_name):
         """更新API设置
@@ -25,56 +45,296 @@ class OllamaClient:
         self.api_url = api_url
         self.model_name = model_name
     
-    def generate(self, prompt):
-        """生成单个响应
+    def generate(self, prompt, on_chunk=None):
+        """生成单个响应（同步接口）
+        
+        Args:
+            prompt: 提示词
+            on_chunk: 可选的回调函数，每收到一段文本时调用
+            
+        Returns:
+            生成的文本响应
+        """
+        return asyncio.run(self.agenerate(prompt, on_chunk))
+    
+    async def agenerate(self, prompt, on_chunk=None, client=None):
+        """异步生成单个响应
+        
+        使用流式接口逐块接收响应，避免Ollama缓冲完整响应后才返回。
+        同一服务、模型和提示词的完整响应会缓存到磁盘，命中时直接返回。
         
         Args:
             prompt: 提示词
+            on_chunk: 可选的回调函数，每收到一段文本时调用
+            client: 可选的httpx.AsyncClient，为None时临时创建
             
         Returns:
             生成的文本响应
         """
+        if client is None:
+            async with self._http_client(asynchronous=True) as client:
+                return await self.agenerate(prompt, on_chunk, client)
+        
+        cache_key = self._cache_key(prompt)
+        cached = self._read_cache(cache_key)
+        if cached is not None:
+            if on_chunk:
+                on_chunk(cached)
+            return cached
+        
         try:
-            response = requests.post(
+            async with client.stream(
+                "POST",
                 f"{self.api_url}/generate",
                 json={
                     "model": self.model_name,
                     "prompt": prompt,
-                    "stream": False,
+                    "stream": True,
                     "options": {
-                        "num_predict": 4096,  # 增加生成的token数量
+                        "num_predict": self.num_predict,
                     }
-                },
-                timeout=self.timeout
-            )
-            
-            if response.status_code == 200:
-                return response.json().get('response', '')
-            else:
-                error_msg = f"API错误: {response.status_code} - {response.text}"
-                print(error_msg)
-                return f"生成失败: {error_msg}"
+                }
+            ) as response:
+                if response.status_code == 200:
+                    text, done, error = await self._accumulate_streaming_response(response, on_chunk)
+                    if error:
+                        # Ollama在流中途出错时会返回error字段，此时内容不完整
+                        error_msg = f"API错误: {error}"
+                        print(error_msg)
+                        return f"生成失败: {error_msg}"
+                    # 只缓存完整结束的响应，连接中断时的部分内容不缓存
+                    if done:
+                        self._write_cache(cache_key, text)
+                    return text
+                else:
+                    await response.aread()
+                    error_msg = f"API错误: {response.status_code} - {response.text}"
+                    print(error_msg)
+                    return f"生成失败: {error_msg}"
         
         except Exception as e:
             error_msg = f"请求异常: {str(e)}"
             print(error_msg)
             return f"生成失败: {error_msg}"
     
-    def generate_with_context(self, prompt, project_path):
+    def embed_batch(self, texts):
+        """批量计算文本向量
+        
+        优先使用 /api/embed 批量接口一次请求完成；如果服务端不支持，
+        则退回到旧的 /api/embeddings 接口逐条请求。
+        
+        Args:
+            texts: 文本列表
+            
+        Returns:
+            与texts顺序对应的向量列表，失败时返回None
+        """
+        try:
+            with self._http_client() as client:
+                response = client.post(
+                    f"{self.api_url}/embed",
+                    json={"model": self.embed_model, "input": texts}
+                )
+                if response.status_code == 200:
+                    embeddings = response.json().get('embeddings')
+                    if embeddings and len(embeddings) == len(texts):
+                        return embeddings
+                
+                # 旧版本Ollama只支持单条请求
+                embeddings = []
+                for text in texts:
+                    response = client.post(
+                        f"{self.api_url}/embeddings",
+                        json={"model": self.embed_model, "prompt": text}
+                    )
+                    if response.status_code != 200:
+                        print(f"API错误: {response.status_code} - {response.text}")
+                        return None
+                    embeddings.append(response.json().get('embedding', []))
+                return embeddings
+        
+        except Exception as e:
+            print(f"请求异常: {str(e)}")
+            return None
+    
+    def _http_client(self, asynchronous=False):
+        """创建复用连接的HTTP客户端
+        
+        Args:
+            asynchronous: 为True时返回httpx.AsyncClient，否则返回httpx.Client
+            
+        Returns:
+            HTTP客户端
+        """
+        import httpx  # 首次请求时再导入，缩短启动时间
+        
+        client_class = httpx.AsyncClient if asynchronous else httpx.Client
+        return client_class(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+            headers={"Connection": "keep-alive"}
+        )
+    
+    async def _accumulate_streaming_response(self, response, on_chunk=None):
+        """拼接流式响应中的NDJSON数据块
+        
+        Args:
+            response: 流式请求的响应
+            on_chunk: 可选的回调函数，每收到一段文本时调用
+            
+        Returns:
+            (拼接后的文本, 是否收到结束标记, 错误信息) 元组，没有错误时错误信息为None
+        """
+        parts = []
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get('error'):
+                return "".join(parts), False, chunk['error']
+            text = chunk.get('response', '')
+            if text:
+                parts.append(text)
+                if on_chunk:
+                    on_chunk(text)
+            if chunk.get('done'):
+                return "".join(parts), True, None
+        return "".join(parts), False, None
+    
+    def _cache_key(self, prompt):
+        """计算响应缓存的键
+        
+        Args:
+            prompt: 提示词
+            
+        Returns:
+            由API地址、模型名称、提示词和生成参数计算出的十六进制哈希值
+        """
+        data = f"{self.api_url}\0{self.model_name}\0{prompt}\0{self.num_predict}".encode('utf-8')
+        return hashlib.blake2b(data, digest_size=32).hexdigest()
+    
+    def _cache_path(self, key):
+        """返回缓存键对应的文件路径"""
+        return os.path.join(self.cache_dir, key[:2], key)
+    
+    def _read_cache(self, key):
+        """读取缓存的响应
+        
+        Args:
+            key: 缓存键
+            
+        Returns:
+            缓存的响应文本，未命中或已过期时返回None
+        """
+        path = self._cache_path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.cache_ttl:
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get('response')
+        except (OSError, ValueError):
+            return None
+    
+    def _write_cache(self, key, text):
+        """原子地写入缓存，失败时忽略
+        
+        Args:
+            key: 缓存键
+            text: 响应文本
+        """
+        if not text:
+            return
+        path = self._cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            is_new = not os.path.exists(path)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({"created": time.time(), "response": text}, f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            if is_new:
+                if self._cache_entries is None:
+                    self._cache_entries = len(self._list_cache_entries())
+                else:
+                    self._cache_entries += 1
+                if self._cache_entries > self.cache_max_entries:
+                    self._evict_cache()
+        except Exception as e:
+            print(f"无法写入缓存 {path}: {str(e)}")
+    
+    def _list_cache_entries(self):
+        """遍历缓存目录
+        
+        Returns:
+            (修改时间, 路径) 元组的列表
+        """
+        entries = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    entries.append((os.path.getmtime(path), path))
+                except OSError:
+                    continue
+        return entries
+    
+    def _evict_cache(self):
+        """缓存条目超过上限时，删除最旧的条目"""
+        entries = self._list_cache_entries()
+        self._cache_entries = len(entries)
+        if len(entries) <= self.cache_max_entries:
+            return
+        
+        entries.sort()
+        for _, path in entries[:len(entries) - self.cache_max_entries]:
+            try:
+                os.remove(path)
+                self._cache_entries -= 1
+            except OSError:
+                pass
+    
+    def generate_with_context(self, prompt, project_path, on_chunk=None):
         """分段处理大型上下文
         
         Args:
             prompt: 基础提示词
             project_path: 项目路径，用于读取文件内容
+            on_chunk: 可选的回调函数，每收到一段文本时以 (响应序号, 文本) 调用
             
         Returns:
             生成的响应列表
         """
+        return asyncio.run(self._agenerate_with_context(prompt, project_path, on_chunk))
+    
+    async def _agenerate_with_context(self, prompt, project_path, on_chunk=None, client=None):
+        """generate_with_context 的异步实现
+        
+        先执行规划阶段，再并发执行实现和完善阶段，所有请求共用一个HTTP客户端。
+        
+        Args:
+            prompt: 基础提示词
+            project_path: 项目路径，用于读取文件内容
+            on_chunk: 可选的回调函数，每收到一段文本时以 (响应序号, 文本) 调用
+            client: 可选的httpx.AsyncClient，为None时临时创建
+            
+        Returns:
+            生成的响应列表
+        """
+        if client is None:
+            async with self._http_client(asynchronous=True) as client:
+                return await self._agenerate_with_context(prompt, project_path, on_chunk, client)
+        
         responses = []
         
         # 第一阶段：项目规划和结构设计
         planning_prompt = prompt + "\n\n首先，请分析需求并提供项目的整体规划和结构设计。"
-        planning_response = self.generate(planning_prompt)
+        planning_response = await self.agenerate(planning_prompt, self._bind_chunk_index(on_chunk, 0), client)
         responses.append(planning_response)
         
         # 从响应中提取计划信息
@@ -83,40 +343,65 @@ class OllamaClient:
         # 第二阶段：逐个实现文件
         if planned_files:
             # 如果AI已经规划了文件，按计划实现
+            prompts = []
+            file_contents = {}  # 本次调用中已读取的文件内容，多个分组引用同一文件时只读取一次
             for file_group in self._group_files(planned_files, 3):  # 每组最多3个文件
-                files_prompt = prompt + "\n\n请实现以下文件:\n" + "\n".join([f"- {f}" for f in file_group])
+                parts = [prompt, "\n\n请实现以下文件:\n", "\n".join([f"- {f}" for f in file_group])]
                 
                 # 如果是修改现有项目，添加现有文件内容
                 for file_path in file_group:
                     full_path = os.path.join(project_path, file_path) if not os.path.isabs(file_path) else file_path
-                    if os.path.exists(full_path):
-                        try:
-                            with open(full_path, 'r', encoding='utf-8') as f:
-                                file_content = f.read()
-                            files_prompt += f"\n\n现有文件 {file_path} 的内容:\n```\n{file_content}\n```"
-                        except Exception as e:
-                            files_prompt += f"\n\n无法读取文件 {file_path}: {str(e)}"
+                    full_path = os.path.abspath(full_path)
+                    if full_path not in file_contents:
+                        file_contents[full_path] = (
+                            self.project_manager.read_file(full_path) if os.path.exists(full_path) else False
+                        )
+                    file_content = file_contents[full_path]
+                    if file_content is None:
+                        parts.append(f"\n\n无法读取文件 {file_path}")
+                    elif file_content is not False:
+                        parts.append(f"\n\n现有文件 {file_path} 的内容:\n```\n{file_content}\n```")
                 
-                implementation_response = self.generate(files_prompt)
-                responses.append(implementation_response)
+                prompts.append("".join(parts))
+            max_concurrency = 2  # 限制并发数，避免Ollama内存不足
         else:
             # 如果AI没有明确规划文件，分批次生成代码
             implementation_prompt = prompt + "\n\n请开始实现项目的核心文件。"
-            implementation_response = self.generate(implementation_prompt)
-            responses.append(implementation_response)
             
             # 继续生成其他必要文件
             followup_prompt = prompt + "\n\n请继续实现项目的其他必要文件，包括配置文件、辅助模块和文档。"
-            followup_response = self.generate(followup_prompt)
-            responses.append(followup_response)
+            prompts = [implementation_prompt, followup_prompt]
+            max_concurrency = 3
         
-        # 第三阶段：完善和测试
+        # 第三阶段：完善和测试（不依赖第二阶段的输出，与之并发执行）
         finalization_prompt = prompt + "\n\n请检查项目的完整性，确保所有必要的文件都已创建，并提供如何运行和测试项目的说明。"
-        finalization_response = self.generate(finalization_prompt)
-        responses.append(finalization_response)
+        prompts.append(finalization_prompt)
+        
+        # 并发请求，结果按提示词顺序返回
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def run(index, p):
+            async with semaphore:
+                return await self.agenerate(p, self._bind_chunk_index(on_chunk, index), client)
+        
+        responses.extend(await asyncio.gather(*(run(i + 1, p) for i, p in enumerate(prompts))))
         
         return responses
     
+    def _bind_chunk_index(self, on_chunk, index):
+        """将响应序号绑定到回调函数，便于区分并发请求的数据块
+        
+        Args:
+            on_chunk: 以 (响应序号, 文本) 调用的回调函数，可以为None
+            index: 响应在返回列表中的序号
+            
+        Returns:
+            只接收文本的回调函数，on_chunk为None时返回None
+        """
+        if on_chunk is None:
+            return None
+        return lambda text: on_chunk(index, text)
+    
     def _extract_planned_files(self, response):
         """从响应中提取计划创建的文件列表
         
@@ -126,24 +411,19 @@ class OllamaClient:
         Returns:
             计划创建的文件路径列表
         """
-        import re
-        
         # 尝试从文件模式中提取
-        file_pattern = r"```file:(.+?)\n"
-        file_matches = re.findall(file_pattern, response)
+        file_matches = _FILE_HDR_RE.findall(response)
         
         if file_matches:
             return [path.strip() for path in file_matches]
         
         # 尝试从项目结构描述中提取
-        structure_pattern = r"(?:项目结构|文件结构|目录结构)[:：]?\s*(?:\n|.)*?(?:```|\n\n)"
-        structure_match = re.search(structure_pattern, response)
+        structure_match = _STRUCT_RE.search(response)
         
         if structure_match:
             structure_text = structure_match.group(0)
             # 查找结构中的文件路径
-            path_pattern = r"[\w\-\.]+\.[\w]+"  # 简单的文件名模式
-            return re.findall(path_pattern, structure_text)
+            return _PATH_RE.findall(structure_text)
         
         return []
     
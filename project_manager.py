@@ -87,6 +87,22 @@ class ProjectManager:
             except Exception:
                 return None
     
+    def read_file_head(self, file_path, max_chars=500):
+        """读取文件开头的部分内容，用于生成摘要
+        
+        Args:
+            file_path: 文件路径
+            max_chars: 最多读取的字符数
+            
+        Returns:
+            文件开头的内容，如果读取失败则返回空字符串
+        """
+        try:
+            with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
+                return f.read(max_chars)
+        except Exception:
+            return ""
+    
     def save_file(self, file_path, content):
         """保存文件内容
         
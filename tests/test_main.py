@@ -0,0 +1,100 @@
+import os
+import queue
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import AIProjectBuilder, _OrderedFileWriter, _StreamFileExtractor
+
+# 引入流式解析前使用的正则表达式
+_ORIGINAL_FILE_RE = re.compile(r"```file:(.+?)\n([\s\S]+?)```")
+
+
+def _random_response(rng):
+    """生成包含文件块、普通代码块和不完整标记的随机响应"""
+    pieces = ["```file:", "```", "\n", "`", "``", "file:", "a.py", "dir/b.txt",
+              "x = 1", " ", "说明文字", "```python\n", "\n\n"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 40)))
+
+
+def _feed_in_chunks(text, rng):
+    """将文本随机切分后逐块送入解析器"""
+    extractor = _StreamFileExtractor()
+    blocks = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, 8)
+        blocks.extend(extractor.feed(text[pos:pos + size]))
+        pos += size
+    return blocks
+
+
+class StreamFileExtractorTest(unittest.TestCase):
+    def test_matches_original_regex(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            text = _random_response(rng)
+            expected = _ORIGINAL_FILE_RE.findall(text)
+            self.assertEqual(_StreamFileExtractor().feed(text), expected, text)
+            self.assertEqual(_feed_in_chunks(text, rng), expected, text)
+
+    def test_simple_response(self):
+        text = "计划\n```file:a.py\nprint(1)\n```\n```file:b/c.txt\nhello\n```"
+        self.assertEqual(_StreamFileExtractor().feed(text),
+                         [("a.py", "print(1)\n"), ("b/c.txt", "hello\n")])
+
+
+class OrderedFileWriterTest(unittest.TestCase):
+    def _run(self, submissions):
+        results = {}
+        lock = threading.Lock()
+
+        def save(file_path, file_content):
+            with lock:
+                results[file_path] = file_content
+
+        writer = _OrderedFileWriter(save)
+        accepted = [writer.submit(*item) for item in submissions]
+        writer.close()
+        return results, accepted
+
+    def test_last_write_wins(self):
+        for _ in range(100):
+            submissions = [((0, i), "/p/a.py", str(i)) for i in range(20)]
+            results, _ = self._run(submissions)
+            self.assertEqual(results, {"/p/a.py": "19"})
+
+    def test_lower_response_index_is_skipped(self):
+        results, accepted = self._run([((1, 0), "/p/a.py", "new"), ((0, 3), "/p/a.py", "old")])
+        self.assertEqual(accepted, [True, False])
+        self.assertEqual(results, {"/p/a.py": "new"})
+
+
+class ProcessAIResponseTest(unittest.TestCase):
+    def setUp(self):
+        self.project_path = tempfile.mkdtemp()
+        # 不创建Tk窗口，只设置process_ai_response用到的属性
+        self.builder = AIProjectBuilder.__new__(AIProjectBuilder)
+        self.builder.project_path = self.project_path
+        self.builder.message_queue = queue.Queue()
+        self.builder._closing = threading.Event()
+        self.builder._dirs_lock = threading.Lock()
+
+    def tearDown(self):
+        shutil.rmtree(self.project_path)
+
+    def test_duplicate_path_keeps_last_block(self):
+        response = "".join(f"```file:pkg/a.py\nv{i}\n```\n" for i in range(30))
+        self.builder.process_ai_response(response, 1, 1)
+        with open(os.path.join(self.project_path, "pkg", "a.py"), encoding="utf-8") as f:
+            self.assertEqual(f.read(), "v29\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,5 @@
 import tkinter as tk
-from tkinter import filedialog, scrolledtext, ttk
+from tkinter import scrolledtext, ttk
 import queue
 import threading
 
@@ -178,6 +178,14 @@ class UIManager:
         self.status_var.set(message)
         self._append_log(f"[状态] {message}")
     
+    def update_progress(self, message):
+        """更新进度信息，只刷新状态栏，不写入日志
+        
+        Args:
+            message: 进度消息
+        """
+        self.status_var.set(message)
+    
     def update_error(self, message):
         """更新错误信息
         